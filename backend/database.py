@@ -1,18 +1,78 @@
 from motor.motor_asyncio import AsyncIOMotorClient
+import asyncio
 import os
 from dotenv import load_dotenv
+from pymongo import monitoring
 
 load_dotenv()
 
 MONGODB_URL = os.environ.get("MONGODB_URL", "mongodb://localhost:27017")
 
-# Keep a short server selection timeout so connection issues fail fast (useful on Render)
-client = AsyncIOMotorClient(MONGODB_URL, serverSelectionTimeoutMS=5000)
+# Connection pool tuning (all overridable from env)
+MONGO_MIN_POOL_SIZE = int(os.environ.get("MONGO_MIN_POOL_SIZE", "5"))
+MONGO_MAX_POOL_SIZE = int(os.environ.get("MONGO_MAX_POOL_SIZE", "50"))
+MONGO_MAX_IDLE_TIME_MS = int(os.environ.get("MONGO_MAX_IDLE_TIME_MS", "300000"))
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.environ.get("MONGO_WAIT_QUEUE_TIMEOUT_MS", "10000"))
+# Comma-separated list, e.g. "zstd,snappy,zlib". Empty disables wire compression.
+MONGO_COMPRESSORS = os.environ.get("MONGO_COMPRESSORS", "zlib").strip()
+
+
+class PoolStatsListener(monitoring.ConnectionPoolListener):
+    """
+    Counts CMAP pool events so pool utilization can be inspected at runtime.
+    """
+    def __init__(self):
+        self.created = 0
+        self.closed = 0
+        self.checked_out = 0
+        self.checkout_failed = 0
+        self.in_use = 0
+
+    def pool_created(self, event): pass
+    def pool_ready(self, event): pass
+    def pool_cleared(self, event): pass
+    def pool_closed(self, event): pass
+    def connection_ready(self, event): pass
+    def connection_check_out_started(self, event): pass
+
+    def connection_created(self, event):
+        self.created += 1
+
+    def connection_closed(self, event):
+        self.closed += 1
+
+    def connection_checked_out(self, event):
+        self.checked_out += 1
+        self.in_use += 1
+
+    def connection_checked_in(self, event):
+        self.in_use = max(0, self.in_use - 1)
+
+    def connection_check_out_failed(self, event):
+        self.checkout_failed += 1
+
+
+pool_stats = PoolStatsListener()
+
+_client_kwargs = {
+    # Keep a short server selection timeout so connection issues fail fast (useful on Render)
+    "serverSelectionTimeoutMS": 5000,
+    "minPoolSize": MONGO_MIN_POOL_SIZE,
+    "maxPoolSize": MONGO_MAX_POOL_SIZE,
+    "maxIdleTimeMS": MONGO_MAX_IDLE_TIME_MS,
+    "waitQueueTimeoutMS": MONGO_WAIT_QUEUE_TIMEOUT_MS,
+    "event_listeners": [pool_stats],
+}
+if MONGO_COMPRESSORS:
+    _client_kwargs["compressors"] = MONGO_COMPRESSORS
+
+client = AsyncIOMotorClient(MONGODB_URL, **_client_kwargs)
 db = client.chatwithdata
 
 # Collections
 users_collection = db.users
 chats_collection = db.chats
+chat_pages_collection = db.chat_pages  # per-page text + content hash, used to rebuild chat indexes
 
 async def ping_db() -> bool:
     """
@@ -26,6 +86,34 @@ async def ping_db() -> bool:
         print(f"❌ MongoDB ping failed: {type(e).__name__}: {e}")
         return False
 
+async def ensure_indexes():
+    # Supports per-user history listing and the streaming export's sort
+    await chats_collection.create_index([("user_id", 1), ("created_at", -1)])
+    await chat_pages_collection.create_index([("chat_id", 1), ("filename", 1), ("page_no", 1)], unique=True)
+
+async def warm_db_pool() -> int:
+    """
+    Open up to MONGO_MIN_POOL_SIZE connections up front so the first requests
+    don't pay connection + TLS handshake cost. Returns the number of pings that succeeded.
+    """
+    results = await asyncio.gather(
+        *(db.command("ping") for _ in range(max(1, MONGO_MIN_POOL_SIZE))),
+        return_exceptions=True,
+    )
+    return sum(1 for r in results if not isinstance(r, Exception))
+
+def get_db_pool_stats() -> dict:
+    return {
+        "min_pool_size": MONGO_MIN_POOL_SIZE,
+        "max_pool_size": MONGO_MAX_POOL_SIZE,
+        "max_idle_time_ms": MONGO_MAX_IDLE_TIME_MS,
+        "compressors": MONGO_COMPRESSORS or None,
+        "open_connections": pool_stats.created - pool_stats.closed,
+        "in_use": pool_stats.in_use,
+        "total_checkouts": pool_stats.checked_out,
+        "checkout_failures": pool_stats.checkout_failed,
+    }
+
 async def get_user(username: str):
     return await users_collection.find_one({"username": username})
 
@@ -1,17 +1,24 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException, Depends, status, Response
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Depends, status, Response
+from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import OAuth2PasswordRequestForm
 from pydantic import BaseModel
 from typing import Optional, List
 from datetime import timedelta, datetime
 from bson import ObjectId
+import asyncio
+import json
+import time
+import zlib
 
 # Env helpers
 import os
 
+EXPORT_BATCH_SIZE = int(os.environ.get("EXPORT_BATCH_SIZE", "200"))  # messages per cursor batch
+
 # Handle imports whether running directly or as module
 try:
-    from backend.rag_service import rag_service
+    from backend.rag_service import rag_service, warm_http_pool, get_http_pool_stats
     from backend.auth import (
         create_access_token, 
         get_current_user, 
@@ -19,9 +26,9 @@ try:
         get_password_hash,
         verify_password
     )
-    from backend.database import get_user, create_user, chats_collection, ping_db
+    from backend.database import get_user, create_user, chats_collection, chat_pages_collection, ping_db, ensure_indexes, warm_db_pool, get_db_pool_stats
 except ImportError:
-    from rag_service import rag_service
+    from rag_service import rag_service, warm_http_pool, get_http_pool_stats
     from auth import (
         create_access_token, 
         get_current_user, 
@@ -29,7 +36,7 @@ except ImportError:
         get_password_hash,
         verify_password
     )
-    from database import get_user, create_user, chats_collection, ping_db
+    from database import get_user, create_user, chats_collection, chat_pages_collection, ping_db, ensure_indexes, warm_db_pool, get_db_pool_stats
 
 app = FastAPI()
 
@@ -38,6 +45,13 @@ app = FastAPI()
 async def _startup_checks():
     ok = await ping_db()
     print("✅ MongoDB connected" if ok else "❌ MongoDB NOT connected (check Render env MONGODB_URL / Atlas user / IP allowlist)")
+    # Pre-warm connection pools so the first real requests skip TCP/TLS setup
+    if ok:
+        await ensure_indexes()
+        warmed = await warm_db_pool()
+        print(f"✅ MongoDB pool warmed ({warmed} connections)")
+    if await asyncio.to_thread(warm_http_pool):
+        print("✅ OpenRouter connection pool warmed")
 
 # CORS origins from env (comma-separated). Default keeps current dev behavior.
 _cors_origins_env = os.environ.get("CORS_ORIGINS", "*").strip()
@@ -83,6 +97,16 @@ def head_root():
 def favicon():
     return Response(status_code=204)
 
+# Connection pool utilization (for tuning MONGO_* / LLM_* pool env vars)
+@app.get("/stats/pools")
+async def pool_stats(current_user: dict = Depends(get_current_user)):
+    return {"mongo": get_db_pool_stats(), "llm_http": get_http_pool_stats()}
+
+# Chat index warm-up and first-question latency (warm vs cold chats)
+@app.get("/stats/warmup")
+async def warmup_stats(current_user: dict = Depends(get_current_user)):
+    return rag_service.get_warmup_stats()
+
 # --- AUTH ROUTES ---
 @app.post("/token", response_model=Token)
 async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends()):
@@ -139,6 +163,58 @@ async def get_chat_history(current_user: dict = Depends(get_current_user)):
         for chat in chats
     ]
 
+async def _export_lines(user_id):
+    """
+    Yield one NDJSON line per chat followed by one line per message. Messages
+    are unwound server-side, so the cursor only ever holds a batch of single
+    messages and memory doesn't grow with chat or account size.
+    """
+    cursor = chats_collection.aggregate([
+        {"$match": {"user_id": user_id}},
+        {"$sort": {"created_at": -1}},  # served by the (user_id, created_at) index
+        {"$project": {"title": 1, "created_at": 1, "filename": 1, "documents": 1, "messages": 1}},
+        {"$unwind": {"path": "$messages", "includeArrayIndex": "index", "preserveNullAndEmptyArrays": True}},
+    ], batchSize=EXPORT_BATCH_SIZE)
+    current_chat = None
+    async for row in cursor:
+        chat_id = str(row['_id'])
+        if chat_id != current_chat:
+            current_chat = chat_id
+            yield json.dumps({
+                "type": "chat",
+                "chat_id": chat_id,
+                "title": row.get('title', 'Untitled Chat'),
+                "created_at": row['created_at'].isoformat() if row.get('created_at') else None,
+                # Chats created before multi-document support only have `filename`
+                "documents": row.get('documents') or ([row['filename']] if row.get('filename') else []),
+            }, default=str) + "\n"
+        if "messages" in row:
+            yield json.dumps({
+                "type": "message",
+                "chat_id": chat_id,
+                "index": row['index'],
+                "message": row['messages'],
+            }, default=str) + "\n"
+
+async def _gzip_stream(lines):
+    compressor = zlib.compressobj(wbits=31)  # 31 = gzip container
+    async for line in lines:
+        chunk = compressor.compress(line.encode("utf-8"))
+        if chunk:
+            yield chunk
+    yield compressor.flush()
+
+# Must be registered before /history/{chat_id} so "export" isn't taken as an id
+@app.get("/history/export")
+async def export_chat_history(gzip: bool = False, current_user: dict = Depends(get_current_user)):
+    lines = _export_lines(current_user['_id'])
+    headers = {"Content-Disposition": 'attachment; filename="chat_history.ndjson"'}
+    if gzip:
+        # Transport-level compression: clients that honour Content-Encoding see plain NDJSON
+        headers["Content-Encoding"] = "gzip"
+        return StreamingResponse(_gzip_stream(lines), media_type="application/x-ndjson", headers=headers)
+    return StreamingResponse(lines, media_type="application/x-ndjson", headers=headers)
+
 @app.get("/history/{chat_id}")
 async def get_chat_messages(chat_id: str, current_user: dict = Depends(get_current_user)):
     print(f"Fetching chat {chat_id} for user {current_user['username']}")
@@ -147,6 +223,9 @@ async def get_chat_messages(chat_id: str, current_user: dict = Depends(get_curre
         if not chat:
             raise HTTPException(status_code=404, detail="Chat not found")
         
+        # Load the chat's index in the background so the first question doesn't pay for it
+        rag_service.prefetch(chat_id)
+
         # Convert _id to str for JSON serialization
         chat['id'] = str(chat['_id'])
         del chat['_id']
@@ -162,6 +241,8 @@ async def delete_chat(chat_id: str, current_user: dict = Depends(get_current_use
         result = await chats_collection.delete_one({"_id": ObjectId(chat_id), "user_id": current_user['_id']})
         if result.deleted_count == 0:
             raise HTTPException(status_code=404, detail="Chat not found")
+        await chat_pages_collection.delete_many({"chat_id": chat_id})
+        rag_service.drop_chat(chat_id)
         return {"message": "Chat deleted successfully"}
     except Exception as e:
         raise HTTPException(status_code=400, detail="Invalid Chat ID")
@@ -170,12 +251,36 @@ async def delete_chat(chat_id: str, current_user: dict = Depends(get_current_use
 @app.post("/upload")
 async def upload_document(
     file: UploadFile = File(...), 
+    chat_id: Optional[str] = Form(None),
     current_user: dict = Depends(get_current_user)
 ):
     if not file.filename.endswith(".pdf"):
         raise HTTPException(status_code=400, detail="Only PDF files are allowed")
     
     content = await file.read()
+
+    # Append to (or update a document in) an existing chat
+    if chat_id:
+        try:
+            target_chat = await chats_collection.find_one({"_id": ObjectId(chat_id), "user_id": current_user['_id']})
+        except Exception:
+            raise HTTPException(status_code=400, detail="Invalid Chat ID")
+        if not target_chat:
+            raise HTTPException(status_code=404, detail="Chat not found")
+
+        rag_result = await rag_service.ingest_file(content, file.filename, chat_id=chat_id)
+        # Only list the document on the chat once it has actually been indexed
+        if rag_result.get("status") != "success":
+            raise HTTPException(status_code=422, detail=f"Could not process file: {rag_result.get('message')}")
+        await chats_collection.update_one(
+            {"_id": target_chat['_id']},
+            {"$addToSet": {"documents": file.filename}}
+        )
+        return {
+            "chat_id": chat_id,
+            "message": "File added to existing chat",
+            "details": rag_result
+        }
     
     # Deduplication: Check if chat already exists for this file
     existing_chat = await chats_collection.find_one({
@@ -184,12 +289,15 @@ async def upload_document(
     })
 
     if existing_chat:
-        # If exists, switch to it without re-processing
+        # If exists, switch to it; only new/changed pages get re-processed
         chat_id = str(existing_chat['_id'])
+        rag_result = await rag_service.ingest_file(content, file.filename, chat_id=chat_id)
+        if rag_result.get("status") == "success" and not rag_result["added"] and not rag_result["removed"]:
+            rag_result = "Using cached version"
         return {
             "chat_id": chat_id,
             "message": "Opened existing chat for this file",
-            "details": "Using cached version"
+            "details": rag_result
         }
 
     # Create new chat session if not exists
@@ -198,13 +306,14 @@ async def upload_document(
         "title": file.filename,
         "created_at": datetime.utcnow(),
         "messages": [],
-        "filename": file.filename
+        "filename": file.filename,
+        "documents": [file.filename]
     }
     result = await chats_collection.insert_one(new_chat)
     chat_id = str(result.inserted_id)
 
     # Process file (RAG)
-    rag_result = await rag_service.ingest_file(content, file.filename)
+    rag_result = await rag_service.ingest_file(content, file.filename, chat_id=chat_id)
     
     return {
         "chat_id": chat_id,
@@ -217,21 +326,55 @@ async def chat(
     request: QueryRequest, 
     current_user: dict = Depends(get_current_user)
 ):
+    # Only answer from chats that belong to the caller
+    if request.chat_id:
+        try:
+            owned = await chats_collection.find_one(
+                {"_id": ObjectId(request.chat_id), "user_id": current_user['_id']},
+                projection={"_id": 1},
+            )
+        except Exception:
+            raise HTTPException(status_code=400, detail="Invalid Chat ID")
+        if not owned:
+            raise HTTPException(status_code=404, detail="Chat not found")
+
+    started = time.perf_counter()
+    was_warm = rag_service.is_warm(request.chat_id)
+    # Joins an in-flight warm-up (e.g. from opening the chat) instead of repeating it
+    if request.chat_id:
+        try:
+            await rag_service.warm_chat(request.chat_id)
+        except Exception:
+            raise HTTPException(status_code=503, detail="Could not load this chat's documents, please try again")
+    wait_ms = (time.perf_counter() - started) * 1000
+
     # Get answer from AI
-    answer = rag_service.ask_question(request.query)
+    # Runs in a worker thread: retries sleep and upstream calls block for up to
+    # LLM_FALLBACK_DEADLINE, which must not stall the event loop or warm-ups
+    # The index is looked up here on the event loop; the thread only reads it
+    index = rag_service.get_index(request.chat_id) if request.chat_id else None
+    answer = await asyncio.to_thread(rag_service.ask_question, request.query, index)
     ai_response = answer.get("answer", "Error")
+    rag_service.record_first_question(
+        request.chat_id, was_warm, (time.perf_counter() - started) * 1000, wait_ms
+    )
 
     # Update Chat History if chat_id is provided
     if request.chat_id:
         await chats_collection.update_one(
-            {"_id": ObjectId(request.chat_id)},
+            {"_id": ObjectId(request.chat_id), "user_id": current_user['_id']},
             {"$push": {"messages": {"$each": [
                 {"role": "user", "text": request.query},
                 {"role": "bot", "text": ai_response}
             ]}}}
         )
     
-    return {"answer": ai_response}
+    response = {"answer": ai_response}
+    # Set when the answer was extracted locally because every upstream model was unavailable
+    if answer.get("degraded"):
+        response["degraded"] = True
+        response["sources"] = answer.get("sources", [])
+    return response
 
 if __name__ == "__main__":
     import uvicorn
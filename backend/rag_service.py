@@ -1,15 +1,61 @@
+import asyncio
+import hashlib
+import io
+import math
 import os
+import re
 import time
-from openai import OpenAI
+import weakref
+from collections import Counter, OrderedDict
+import httpx
+from openai import APITimeoutError, OpenAI, RateLimitError
 from pypdf import PdfReader
+from pypdf.generic import IndirectObject, StreamObject
+from pymongo import DeleteMany, UpdateOne
 from dotenv import load_dotenv
 
+try:
+    from backend.database import chat_pages_collection
+except ImportError:
+    from database import chat_pages_collection
+
 # Load env from parent directory
 load_dotenv(os.path.join(os.path.dirname(__file__), '..', '.env'), override=True)
 
+# HTTP transport tuning for the LLM client (all overridable from env)
+LLM_MAX_CONNECTIONS = int(os.environ.get("LLM_MAX_CONNECTIONS", "20"))
+LLM_MAX_KEEPALIVE = int(os.environ.get("LLM_MAX_KEEPALIVE", "10"))
+LLM_KEEPALIVE_EXPIRY = float(os.environ.get("LLM_KEEPALIVE_EXPIRY", "60"))
+LLM_CONNECT_TIMEOUT = float(os.environ.get("LLM_CONNECT_TIMEOUT", "5"))
+LLM_READ_TIMEOUT = float(os.environ.get("LLM_READ_TIMEOUT", "60"))
+LLM_HTTP2 = os.environ.get("LLM_HTTP2", "1").strip().lower() not in ("0", "false", "no")
+
+def _http2_available() -> bool:
+    # httpx only speaks HTTP/2 when the optional `h2` package is installed
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+def build_http_client() -> httpx.Client:
+    """
+    Shared keep-alive connection pool for all upstream LLM calls.
+    """
+    return httpx.Client(
+        http2=LLM_HTTP2 and _http2_available(),
+        limits=httpx.Limits(
+            max_connections=LLM_MAX_CONNECTIONS,
+            max_keepalive_connections=LLM_MAX_KEEPALIVE,
+            keepalive_expiry=LLM_KEEPALIVE_EXPIRY,
+        ),
+        timeout=httpx.Timeout(LLM_READ_TIMEOUT, connect=LLM_CONNECT_TIMEOUT),
+    )
+
 # OpenRouter Configuration (Primary - Unlimited Credits)
 openrouter_api_key = os.environ.get("OPENROUTER_API_KEY")
 openrouter_client = None
+http_client = build_http_client()
 
 if not openrouter_api_key:
     print("❌ Error: OPENROUTER_API_KEY not found in .env")
@@ -17,9 +63,204 @@ else:
     openrouter_client = OpenAI(
         base_url="https://openrouter.ai/api/v1",
         api_key=openrouter_api_key,
+        http_client=http_client,
     )
     print(f"✅ OpenRouter Configured (Key starts with: {openrouter_api_key[:10]}...)")
 
+def warm_http_pool() -> bool:
+    """
+    Open a connection to OpenRouter ahead of the first question so the TLS
+    handshake isn't paid on the request path. Blocking; run it off the event loop.
+    """
+    if not openrouter_client:
+        return False
+    try:
+        openrouter_client.models.list()
+        return True
+    except Exception as e:
+        print(f"⚠️ OpenRouter pre-warm failed: {type(e).__name__}: {e}")
+        return False
+
+def get_http_pool_stats() -> dict:
+    stats = {
+        "http2": LLM_HTTP2 and _http2_available(),
+        "max_connections": LLM_MAX_CONNECTIONS,
+        "max_keepalive_connections": LLM_MAX_KEEPALIVE,
+        "keepalive_expiry": LLM_KEEPALIVE_EXPIRY,
+    }
+    # httpcore doesn't expose a public stats API; inspect the pool defensively
+    pool = getattr(getattr(http_client, "_transport", None), "_pool", None)
+    connections = getattr(pool, "connections", None)
+    if connections is not None:
+        stats["open_connections"] = len(connections)
+        stats["idle_connections"] = sum(1 for c in connections if c.is_idle())
+    return stats
+
+# Max chat indexes kept in memory; least recently used ones are evicted
+INDEX_CACHE_SIZE = int(os.environ.get("RAG_INDEX_CACHE_SIZE", "100"))
+# Compact an index once this many tombstoned chunks have accumulated
+COMPACTION_THRESHOLD = int(os.environ.get("RAG_COMPACTION_THRESHOLD", "200"))
+
+# Seconds after which no further upstream retries are started and the answer is
+# extracted from the document locally instead (does not cut short an in-flight call)
+LLM_FALLBACK_DEADLINE = float(os.environ.get("LLM_FALLBACK_DEADLINE", "8"))
+
+_WORD_RE = re.compile(r"\w+")
+_SENTENCE_RE = re.compile(r"(?<=[.!?])\s+|\n\s*\n")
+
+def _tokenize(text):
+    return {w for w in _WORD_RE.findall(text.lower()) if len(w) > 3}
+
+def _object_digest(obj, memo):
+    """
+    Digest a PDF object together with everything it references. `memo` caches
+    indirect objects so resources shared between pages (fonts, images) are only
+    hashed once per upload.
+    """
+    if isinstance(obj, IndirectObject):
+        key = (obj.idnum, obj.generation)
+        if key not in memo:
+            memo[key] = b"cycle"  # guards against self-referencing objects
+            memo[key] = _object_digest(obj.get_object(), memo)
+        return memo[key]
+    h = hashlib.sha1(type(obj).__name__.encode())
+    if isinstance(obj, StreamObject):
+        # Hash the still-encoded bytes: the base-class get_data() returns them
+        # without running filters, and /Filter + /DecodeParms are covered by the
+        # dictionary walk below, so nothing needs decompressing
+        h.update(StreamObject.get_data(obj))
+    if isinstance(obj, dict):
+        for key in sorted(obj):
+            if key == "/Parent":
+                continue
+            h.update(str(key).encode())
+            h.update(_object_digest(obj.raw_get(key), memo))
+    elif isinstance(obj, list):
+        for item in obj:
+            h.update(_object_digest(item, memo))
+    else:
+        h.update(repr(obj).encode())
+    return h.digest()
+
+def _page_hash(page, memo):
+    """
+    Hash everything that affects a page's extracted text: its content streams
+    plus the resolved /Resources (fonts, Form XObjects) they draw with. This
+    detects unchanged pages without running text extraction on them.
+    """
+    h = hashlib.sha1()
+    for key in ("/Contents", "/Resources", "/Rotate"):
+        if key in page:
+            h.update(key.encode())
+            h.update(_object_digest(page.raw_get(key), memo))
+    return h.hexdigest()
+
+def _is_unavailable(error):
+    """
+    True for upstream failures the local extractive fallback should cover:
+    rate limits and timeouts. Anything else (bad key, bad request) is a real error.
+    """
+    if isinstance(error, (RateLimitError, APITimeoutError)):
+        return True
+    error_str = str(error).lower()
+    return "429" in error_str or "rate" in error_str
+
+def extractive_answer(query, chunks, max_sentences=3):
+    """
+    Rank the sentences of `chunks` against `query` with TF-IDF and return the
+    best ones (in document order) plus the snippets they came from, or None if
+    nothing usable was found.
+    """
+    sentences = []  # (sentence, chunk position)
+    for pos, chunk in enumerate(chunks):
+        for sentence in _SENTENCE_RE.split(chunk):
+            sentence = " ".join(sentence.split())
+            if len(sentence) >= 20:
+                sentences.append((sentence, pos))
+    if not sentences:
+        return None
+
+    term_counts = [Counter(w for w in _WORD_RE.findall(s.lower()) if len(w) > 3) for s, _ in sentences]
+    doc_freq = Counter()
+    for counts in term_counts:
+        doc_freq.update(counts.keys())
+    n = len(sentences)
+    query_terms = _tokenize(query)
+
+    scores = []
+    for i, counts in enumerate(term_counts):
+        score = sum(
+            (1 + math.log(counts[t])) * math.log(1 + n / doc_freq[t])
+            for t in query_terms if t in counts
+        )
+        # Dampen the advantage of very long sentences
+        scores.append(score / math.sqrt(1 + sum(counts.values())))
+
+    ranked = sorted(range(n), key=lambda i: -scores[i])
+    best = [i for i in ranked if scores[i] > 0][:max_sentences] or list(range(min(max_sentences, n)))
+    best.sort()
+
+    used = sorted({sentences[i][1] for i in best})
+    return {
+        "sentences": [sentences[i][0] for i in best],
+        "sources": [chunks[pos][:200].strip() for pos in used],
+    }
+
+class ChatIndex:
+    """
+    Per-chat chunk store with an inverted index. Removed chunks are tombstoned
+    and only dropped from the postings when compact() runs.
+    """
+    def __init__(self):
+        self.documents = {}  # filename -> [(page_hash, [chunk_id, ...]), ...] in page order
+        self.chunks = {}  # chunk_id -> text
+        self.postings = {}  # term -> set(chunk_id)
+        self.tombstones = set()
+        self._next_id = 0
+
+    def add_chunk(self, text):
+        chunk_id = self._next_id
+        self._next_id += 1
+        self.chunks[chunk_id] = text
+        for term in _tokenize(text):
+            self.postings.setdefault(term, set()).add(chunk_id)
+        return chunk_id
+
+    def tombstone(self, chunk_ids):
+        self.tombstones.update(chunk_ids)
+        return len(chunk_ids)
+
+    def compact(self):
+        if not self.tombstones:
+            return
+        dead = self.tombstones
+        # Build new containers rather than mutating in place, since ask_question
+        # may be reading this index from a worker thread
+        self.postings = {
+            term: ids - dead for term, ids in self.postings.items() if not ids <= dead
+        }
+        self.chunks = {cid: text for cid, text in self.chunks.items() if cid not in dead}
+        self.tombstones = set()
+        print(f"🧹 Compacted {len(dead)} tombstoned chunks")
+
+    def live_count(self):
+        return len(self.chunks) - len(self.tombstones)
+
+    def live_chunks(self):
+        # chunk ids increase monotonically, so dict order is insertion order
+        return [text for cid, text in list(self.chunks.items()) if cid not in self.tombstones]
+
+    def search(self, query, top_k=3):
+        scores = {}
+        for term in _tokenize(query):
+            # Snapshot the posting list; uploads may add to it while we iterate
+            for chunk_id in tuple(self.postings.get(term, ())):
+                if chunk_id not in self.tombstones:
+                    scores[chunk_id] = scores.get(chunk_id, 0) + 1
+        best = sorted(scores, key=lambda cid: (-scores[cid], cid))[:top_k]
+        chunks = self.chunks
+        return [chunks[cid] for cid in best if cid in chunks]
+
 class RagService:
     def __init__(self):
         # Multiple Free OpenRouter Models (All Free - Auto Fallback)
@@ -34,7 +275,16 @@ class RagService:
             "deepseek/deepseek-r1-0528:free",
         ]
         self.model_index = 0  # Start with first model
-        self.chunks = []
+        self.indexes = OrderedDict()  # chat_id -> ChatIndex, in LRU order
+        self.index_cache_size = INDEX_CACHE_SIZE
+        self.compaction_threshold = COMPACTION_THRESHOLD
+        self._warming = {}  # chat_id -> in-flight warm-up task
+        self._ingest_locks = weakref.WeakValueDictionary()  # chat_id -> asyncio.Lock while in use
+        self._asked = set()  # cached chat_ids that have had their first question
+        self.first_question_stats = {
+            "warm": {"count": 0, "total_ms": 0.0},
+            "cold": {"count": 0, "total_ms": 0.0, "wait_ms": 0.0},
+        }
 
     def chunk_text(self, text, chunk_size=1000, overlap=100):
         chunks = []
@@ -45,59 +295,238 @@ class RagService:
             start += (chunk_size - overlap)
         return chunks
 
-    def find_relevant_chunks(self, query, top_k=3):
-        if not self.chunks:
-            return []
-        
-        query_words = set(query.lower().split())
-        scored_chunks = []
-
-        for chunk in self.chunks:
-            score = 0
-            chunk_lower = chunk.lower()
-            for word in query_words:
-                if len(word) > 3 and word in chunk_lower:
-                    score += 1
-            scored_chunks.append((score, chunk))
-        
-        scored_chunks.sort(key=lambda x: x[0], reverse=True)
-        return [chunk for score, chunk in scored_chunks[:top_k]]
+    def get_index(self, chat_id):
+        index = self.indexes.get(chat_id)
+        if index is not None:
+            self.indexes.move_to_end(chat_id)
+        return index
+
+    def _cache_index(self, chat_id, index):
+        self.indexes[chat_id] = index
+        self.indexes.move_to_end(chat_id)
+        while len(self.indexes) > self.index_cache_size:
+            evicted, _ = self.indexes.popitem(last=False)
+            # Reopening an evicted chat is a cold start again
+            self._asked.discard(evicted)
+        return index
+
+    def is_warm(self, chat_id):
+        return chat_id in self.indexes
+
+    def prefetch(self, chat_id):
+        """
+        Start (or join) a background load of chat_id's index from stored pages.
+        Returns the in-flight task, or None if the index is already in memory.
+        """
+        if not chat_id or chat_id in self.indexes:
+            return None
+        task = self._warming.get(chat_id)
+        if task is None:
+            task = asyncio.create_task(self._load_index(chat_id))
+            self._warming[chat_id] = task
+            task.add_done_callback(lambda t: self._warm_done(chat_id, t))
+        return task
 
-    async def ingest_file(self, file_content: bytes, filename: str):
+    def _warm_done(self, chat_id, task):
+        self._warming.pop(chat_id, None)
+        # Mark a fire-and-forget prefetch's failure as retrieved; awaiting
+        # callers still get the exception from warm_chat
+        if not task.cancelled():
+            task.exception()
+
+    async def warm_chat(self, chat_id):
+        """
+        Wait for chat_id's index to be in memory. Raises if it couldn't be loaded,
+        so callers don't carry on with an empty index.
+        """
+        task = self.prefetch(chat_id)
+        if task:
+            await task
+
+    async def _load_index(self, chat_id):
+        started = time.perf_counter()
+        index = ChatIndex()
         try:
-            with open(filename, "wb") as f:
-                f.write(file_content)
-            
-            reader = PdfReader(filename)
-            text = ""
-            for page in reader.pages:
-                t = page.extract_text()
-                if t: text += t + "\n"
-            
-            self.chunks = self.chunk_text(text)
-            
-            if os.path.exists(filename):
-                os.remove(filename)
-            
-            msg = f"Processed {len(self.chunks)} chunks from {filename}."
+            cursor = chat_pages_collection.find(
+                {"chat_id": chat_id},
+                projection={"_id": 0, "filename": 1, "hash": 1, "text": 1},
+            ).sort([("filename", 1), ("page_no", 1)])
+            async for page in cursor:
+                chunk_ids = [index.add_chunk(c) for c in self.chunk_text(page.get("text", ""))]
+                index.documents.setdefault(page["filename"], []).append((page["hash"], chunk_ids))
+        except Exception as e:
+            # Nothing is cached, so the next caller retries the load
+            print(f"⚠️ Warm-up failed for chat {chat_id}: {type(e).__name__}: {e}")
+            raise
+        # An upload may have built the index while we were reading. Chats with no
+        # stored pages are cached empty so they aren't looked up again.
+        if chat_id not in self.indexes:
+            self._cache_index(chat_id, index)
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            print(f"🔥 Warmed chat {chat_id}: {index.live_count()} chunks in {elapsed_ms:.0f}ms")
+
+    def drop_chat(self, chat_id):
+        self.indexes.pop(chat_id, None)
+        self._asked.discard(chat_id)
+
+    def record_first_question(self, chat_id, was_warm, elapsed_ms, wait_ms=0.0):
+        """
+        Track latency of the first question asked in each chat, split by whether
+        its index was already in memory when the question arrived.
+        """
+        if chat_id not in self.indexes or chat_id in self._asked:
+            return
+        self._asked.add(chat_id)
+        bucket = self.first_question_stats["warm" if was_warm else "cold"]
+        bucket["count"] += 1
+        bucket["total_ms"] += elapsed_ms
+        if not was_warm:
+            bucket["wait_ms"] += wait_ms
+
+    def get_warmup_stats(self):
+        stats = {"in_flight": len(self._warming), "cached_chats": len(self.indexes)}
+        for name, bucket in self.first_question_stats.items():
+            count = bucket["count"]
+            stats[name] = {
+                "count": count,
+                "avg_ms": round(bucket["total_ms"] / count, 1) if count else None,
+            }
+            if "wait_ms" in bucket:
+                stats[name]["avg_wait_ms"] = round(bucket["wait_ms"] / count, 1) if count else None
+        return stats
+
+    async def ingest_file(self, file_content: bytes, filename: str, chat_id: str):
+        """
+        Add or update `filename` in the chat's index. Pages whose content hash
+        already exists in the previous version are reused; chunks of changed or
+        removed pages are tombstoned and compacted in the background. The index
+        is only touched once extraction and the chat_pages write have succeeded.
+        """
+        lock = self._ingest_locks.get(chat_id)
+        if lock is None:
+            lock = self._ingest_locks[chat_id] = asyncio.Lock()
+        # Serialize uploads per chat so concurrent ones never diff against the same old version
+        async with lock:
+            return await self._ingest_file(file_content, filename, chat_id)
+
+    async def _ingest_file(self, file_content, filename, chat_id):
+        try:
+            started = time.perf_counter()
+            # Pull previously stored pages into memory so unchanged ones are reused
+            await self.warm_chat(chat_id)
+            index = self.get_index(chat_id) or self._cache_index(chat_id, ChatIndex())
+            reader = PdfReader(io.BytesIO(file_content))
+            old_pages = index.documents.get(filename, [])
+            new_pages = []  # (page_hash, chunk_ids), or (page_hash, None) until new text is indexed
+            new_texts = {}  # page_no -> extracted text for new/changed pages
+            page_writes = []
+
+            # Match pages by content hash, not position, so inserting or
+            # reordering pages doesn't force the rest to be re-extracted
+            old_by_hash = {}
+            for old_no, (page_hash, chunk_ids) in enumerate(old_pages):
+                old_by_hash.setdefault(page_hash, []).append((old_no, chunk_ids))
+            moved = {}  # new page_no -> old page_no for reused pages that shifted
+            memo = {}
+
+            for page_no, page in enumerate(reader.pages):
+                page_hash = _page_hash(page, memo)
+                if old_by_hash.get(page_hash):
+                    old_no, chunk_ids = old_by_hash[page_hash].pop(0)
+                    new_pages.append((page_hash, chunk_ids))
+                    if old_no != page_no:
+                        moved[page_no] = old_no
+                    continue
+                text = page.extract_text() or ""
+                new_texts[page_no] = text
+                new_pages.append((page_hash, None))
+                page_writes.append(UpdateOne(
+                    {"chat_id": chat_id, "filename": filename, "page_no": page_no},
+                    {"$set": {"hash": page_hash, "text": text}},
+                    upsert=True,
+                ))
+
+            # Old pages whose content no longer appears in the new version
+            dead = [cid for entries in old_by_hash.values() for _, chunk_ids in entries for cid in chunk_ids]
+
+            # Reused pages keep their chunks but are stored under their new page number
+            if moved:
+                cursor = chat_pages_collection.find(
+                    {"chat_id": chat_id, "filename": filename, "page_no": {"$in": list(set(moved.values()))}},
+                    projection={"_id": 0, "page_no": 1, "text": 1},
+                )
+                old_texts = {p["page_no"]: p.get("text", "") async for p in cursor}
+                for page_no, old_no in moved.items():
+                    page_writes.append(UpdateOne(
+                        {"chat_id": chat_id, "filename": filename, "page_no": page_no},
+                        {"$set": {"hash": new_pages[page_no][0], "text": old_texts.get(old_no, "")}},
+                        upsert=True,
+                    ))
+            if len(old_pages) > len(new_pages):
+                page_writes.append(DeleteMany(
+                    {"chat_id": chat_id, "filename": filename, "page_no": {"$gte": len(new_pages)}}
+                ))
+
+            if page_writes:
+                await chat_pages_collection.bulk_write(page_writes, ordered=False)
+
+            # Everything succeeded: swap the new version into the index
+            added = 0
+            for page_no, text in new_texts.items():
+                chunk_ids = [index.add_chunk(c) for c in self.chunk_text(text)]
+                added += len(chunk_ids)
+                new_pages[page_no] = (new_pages[page_no][0], chunk_ids)
+            removed = index.tombstone(dead)
+            index.documents[filename] = new_pages
+
+            if len(index.tombstones) >= self.compaction_threshold:
+                asyncio.get_running_loop().call_soon(index.compact)
+
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            msg = (f"Processed {filename}: {added} chunks added, {removed} removed, "
+                   f"{index.live_count()} live in {elapsed_ms:.0f}ms.")
             print(msg)
-            return {"status": "success", "message": msg}
+            return {"status": "success", "message": msg, "added": added, "removed": removed}
         except Exception as e:
-            if os.path.exists(filename):
-                os.remove(filename)
             return {"status": "error", "message": str(e)}
 
-    def ask_question(self, query: str):
-        if not self.chunks:
+    def _wait_before_retry(self, seconds, deadline):
+        """
+        Sleep before another upstream attempt, unless that would run past the
+        fallback deadline. Returns False when the caller should give up.
+        """
+        if time.monotonic() + seconds > deadline:
+            return False
+        time.sleep(seconds)
+        return True
+
+    def _degraded_answer(self, query, chunks):
+        result = extractive_answer(query, chunks)
+        if not result:
+            return {"answer": "Sorry, all free models are currently rate-limited. Please wait 5-10 minutes and try again, or check your OpenRouter account limits."}
+        print("🛟 Upstream models unavailable, answering from document excerpts")
+        bullets = "\n".join(f"> {sentence}\n" for sentence in result["sentences"])
+        answer = (
+            "_All AI models are busy right now, so here are the most relevant passages "
+            f"from your document:_\n\n{bullets}"
+        )
+        return {"answer": answer, "degraded": True, "sources": result["sources"]}
+
+    def ask_question(self, query: str, index):
+        """
+        Answer `query` from a ChatIndex looked up by the caller. This runs in a
+        worker thread, so it must not touch self.indexes.
+        """
+        if not index or not index.live_count():
             return {"answer": "Please upload a document first."}
         
         if not openrouter_client:
             return {"answer": "API Key not configured. Please add OPENROUTER_API_KEY in .env file."}
 
-        relevant_chunks = self.find_relevant_chunks(query)
+        relevant_chunks = index.search(query) or index.live_chunks()[:3]
         context = "\n...\n".join(relevant_chunks)
-        if not context:
-             context = "\n...\n".join(self.chunks[:3])
+        deadline = time.monotonic() + LLM_FALLBACK_DEADLINE
+        last_error = None
 
         system_prompt = """You are an intelligent analyst.
         - Answer naturally and professionally.
@@ -106,16 +535,20 @@ class RagService:
 
         user_prompt = f"CONTEXT:\n{context}\n\nQUESTION: {query}"
 
-        # Try all free models with automatic fallback
+        # Try all free models with automatic fallback. The rotation is tracked
+        # per call, since concurrent questions run in separate threads
+        model_index = self.model_index
         max_model_attempts = len(self.free_models)
         for model_attempt in range(max_model_attempts):
-            current_model = self.free_models[self.model_index]
+            current_model = self.free_models[model_index]
             
             # Retry logic for each model
             max_retries = 3
             for attempt in range(max_retries):
                 try:
-                    completion = openrouter_client.chat.completions.create(
+                    # An in-flight call gets the normal LLM_READ_TIMEOUT; the SDK's own
+                    # retries are disabled so only this loop decides whether to retry
+                    completion = openrouter_client.with_options(max_retries=0).chat.completions.create(
                         extra_headers={
                             "HTTP-Referer": "http://localhost:3000",
                             "X-Title": "Chatify.AI",
@@ -127,29 +560,31 @@ class RagService:
                         ]
                     )
                     
-                    # Success! Reset to first model for next time
-                    self.model_index = 0
+                    # Success! The next question starts from the first model again
                     print(f"✅ Response from {current_model}")
                     return {"answer": completion.choices[0].message.content}
                     
                 except Exception as e:
-                    error_str = str(e)
+                    last_error = e
                     print(f"⚠️ Error (Model: {current_model}, Attempt: {attempt+1}): {e}")
                     
-                    # Check if it's a 429 rate limit error
-                    if "429" in error_str or "rate" in error_str.lower() or "rate-limited" in error_str.lower():
+                    # Rate limits and timeouts: back off, but hand over to the local
+                    # fallback rather than retrying past LLM_FALLBACK_DEADLINE
+                    if _is_unavailable(e):
                         # If last retry for this model, try next model immediately
                         if attempt == max_retries - 1:
                             print(f"🔄 Model {current_model} rate-limited, switching to next model...")
                             # Move to next model
-                            self.model_index = (self.model_index + 1) % len(self.free_models)
-                            time.sleep(1)  # Short wait before trying next model
+                            model_index = (model_index + 1) % len(self.free_models)
+                            if not self._wait_before_retry(1, deadline):  # Short wait before trying next model
+                                return self._degraded_answer(query, relevant_chunks)
                             break  # Break retry loop, try next model
                         else:
                             # Wait before retrying same model
                             wait_time = min((2 ** attempt) + 1, 5)  # Max 5 seconds
                             print(f"⏳ Rate limited, waiting {wait_time} seconds before retry...")
-                            time.sleep(wait_time)
+                            if not self._wait_before_retry(wait_time, deadline):
+                                return self._degraded_answer(query, relevant_chunks)
                             continue
                     else:
                         # Other errors - retry with delay
@@ -159,13 +594,15 @@ class RagService:
                         # If last retry, try next model
                         if model_attempt < max_model_attempts - 1:
                             print(f"🔄 Model {current_model} failed, trying next model...")
-                            self.model_index = (self.model_index + 1) % len(self.free_models)
+                            model_index = (model_index + 1) % len(self.free_models)
                             time.sleep(1)
                             break
             
-            # If we've tried all models, return helpful error
+            # If we've tried all models, answer locally only if they were unavailable
             if model_attempt == max_model_attempts - 1:
-                return {"answer": "Sorry, all free models are currently rate-limited. Please wait 5-10 minutes and try again, or check your OpenRouter account limits."}
+                if last_error is not None and _is_unavailable(last_error):
+                    return self._degraded_answer(query, relevant_chunks)
+                return {"answer": f"Error: Unable to generate response ({type(last_error).__name__}). Please try again."}
         
         return {"answer": "Error: Unable to generate response. Please try again."}
 